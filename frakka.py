@@ -1,4 +1,4 @@
-from utils import Logger, DirHandler, FileReader, Counter, Output, ReadRecord
+from utils import Logger, DirHandler, FileReader, Counter, Output, ReadRecord, ReadSorter, ReadSelector
 from plot import CountPlotter, ReadPlotter
 from datetime import datetime
 import argparse
@@ -32,6 +32,14 @@ def set_parsers():
 	parser.add_argument('--delim', '-del', default='\t', help='Specify output file delimiter')
 	parser.add_argument('--minreads', '-m', default=0, help='Specify the minimum number of reads per species (filters low-abundance species)')
 	parser.add_argument('--groupother', '-g', default=0, help='Group all species with fewer than the specified number of reads into an "Other" group for plotting')
+	parser.add_argument('--sample', '-sa', default=None, help='Preview mode: estimate results from a uniform (reservoir) sample of the specified number of classified reads per Kraken output file')
+	parser.add_argument('--fraction', '-fr', default=None, help='Preview mode: estimate results from every 1/fraction-th classified read (stride sampling) of each Kraken output file')
+	parser.add_argument('--precision', '-pr', default=None, help='Stop reading early once the 95%% confidence interval of every species\' read fraction is within +/- the specified value (requires --fraction, assumes reads are not ordered by species)')
+	parser.add_argument('--seed', '-se', default=None, help='Random seed for --sample')
+	parser.add_argument('--sort-by', '-sb', default=None, help='Sort per-read output by a comma-separated list of fields (file, truespec, species, read_id, score; use score:desc for descending order)')
+	parser.add_argument('--sort-buffer', '-sbu', default=1000000, help='Maximum number of reads held in memory by --sort-by before sorted chunks are written to temporary files in the output directory')
+	parser.add_argument('--top-n', '-tn', default=None, help='Only report the specified number of highest scoring reads per species in per-read output')
+	parser.add_argument('--bottom-n', '-bn', default=None, help='Only report the specified number of lowest scoring reads per species in per-read output')
 
 	args = parser.parse_args()
 	return args, parser
@@ -63,6 +71,37 @@ def main():
 		msg('You need to specify either both --kreport and --kout or alternatively, --fof. Exiting.')
 		parser.print_help(sys.stderr)
 		
+	if args.sample and args.fraction:
+		err('Provide either --sample or --fraction for preview mode, not both. Exiting.')
+
+	if args.precision and not args.fraction:
+		err('--precision can only be used with --fraction (reservoir sampling via --sample has to read the entire file). Exiting.')
+
+	if args.fraction and not 0 < float(args.fraction) <= 1:
+		err(f'--fraction has to be between 0 and 1 but is {args.fraction}. Exiting.')
+
+	preview = bool(args.sample or args.fraction)
+
+	if (args.sort_by or args.top_n or args.bottom_n) and args.counts:
+		err('--sort-by, --top-n and --bottom-n only apply to per-read output and cannot be combined with --counts. Exiting.')
+
+	if args.top_n and args.bottom_n:
+		err('Provide either --top-n or --bottom-n, not both. Exiting.')
+
+	if int(args.top_n or args.bottom_n or 1) < 1:
+		err(f'--top-n / --bottom-n has to be at least 1 but is {args.top_n or args.bottom_n}. Exiting.')
+
+	if int(args.sort_buffer) < 1:
+		err(f'--sort-buffer has to be at least 1 but is {args.sort_buffer}. Exiting.')
+
+	sorter = None
+	if args.sort_by:
+		sorter = ReadSorter(sort_by=args.sort_by, tmpdir=outdir, buffer_size=args.sort_buffer)
+
+	selector = None
+	if args.top_n or args.bottom_n:
+		selector = ReadSelector(n=args.top_n or args.bottom_n, lowest=bool(args.bottom_n))
+
 	if args.fof:
 		fof = FileReader(cwd=os.getcwd(), file=args.fof, ftype='fof')
 		file_s = fof.fileOfFiles()
@@ -110,10 +149,23 @@ def main():
 		specmap = report.readKReport()
 
 		krak = FileReader(cwd=os.getcwd(), file=f[1], ftype='krak', score=float(args.score))
-		kll = krak.readKraken()
+		if preview:
+			sample = krak.sampleKraken(specmap=specmap, size=int(args.sample) if args.sample else None,
+										fraction=float(args.fraction) if args.fraction else None,
+										precision=float(args.precision) if args.precision else None,
+										seed=int(args.seed) if args.seed else None)
+			kll = sample.kll
+		elif sorter or selector:
+			# Stream reads so that memory stays bounded by --sort-buffer / --top-n / --bottom-n
+			kll = krak.iterKraken()
+		else:
+			kll = krak.readKraken()
 
 		if args.counts:
-			counts = Counter.getCounts(specmap=specmap, kll=kll, truespec=truespec, file=f[1])
+			if preview:
+				counts = Counter.getSampledCounts(specmap=specmap, sample=sample, truespec=truespec, file=f[1])
+			else:
+				counts = Counter.getCounts(specmap=specmap, kll=kll, truespec=truespec, file=f[1])
 
 			for cr in counts:
 				if not args.taxid:
@@ -140,7 +192,12 @@ def main():
 					kspec = kl.taxid
 
 				rec = ReadRecord(file=f[1], truespec=truespec, kspec=kspec, read_id=kl.read_id, score=kl.score)
-				rec_lst.append(rec.join(args.delim))
+				if selector:
+					selector.add(rec)
+				elif sorter:
+					sorter.add(rec)
+				else:
+					rec_lst.append(rec.join(args.delim))
 
 				if args.plot:
 					scores.append(rec)
@@ -151,6 +208,16 @@ def main():
 
 		outlst += rec_lst
 
+	if selector:
+		for rec in selector.records():
+			if sorter:
+				sorter.add(rec)
+			else:
+				outlst.append(rec.join(args.delim))
+
+	if sorter:
+		outlst = (rec.join(args.delim) for rec in sorter.records())
+
 	if not args.tofile:
 		fh = sys.stdout
 	else:
@@ -163,7 +230,7 @@ def main():
 
 	for c,o in enumerate(outlst):
 		if c == 0:
-			header = Output(record=None, isHeader=True, sep=args.delim, counts=args.counts, useTaxid=args.taxid, fh=fh)
+			header = Output(record=None, isHeader=True, sep=args.delim, counts=args.counts, useTaxid=args.taxid, sampled=preview, fh=fh)
 			header.printRecord()
 
 		out = Output(record=o, sep=args.delim, counts=args.counts, useTaxid=args.taxid, fh=fh)
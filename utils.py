@@ -1,5 +1,9 @@
 import os
 import sys
+import heapq
+import random
+import tempfile
+from math import sqrt, floor, ceil
 from datetime import datetime
 from statistics import median
 
@@ -139,6 +143,104 @@ class FileReader:
 
 		# Returns a list of KrakenLine objects
 		return krak
+
+	def iterKraken(self):
+		'''
+		Reads a read-level Kraken output file line by line
+		and returns a generator of KrakenLine objects, so that the file is never held in memory
+		'''
+		if self.ftype != 'krak':
+			raise TypeError(f'INTERNAL ERROR: Cannot call method iterKraken() on a file with ftype {self.ftype}!')
+
+		path = self._checkPath()
+
+		with open(path, 'r') as f:
+			msg(f'Streaming Kraken output file {self.file}')
+			for line in f:
+				cols = [c.strip() for c in line.rstrip('\n').split('\t')]
+				if cols[0] == 'U':
+					continue
+
+				kl = KrakenLine(uc=cols[0], read_id=cols[1], taxid=cols[2], kmerstr=cols[4])
+				if kl.score >= self.score:
+					yield kl
+
+	def sampleKraken(self, specmap, size=None, fraction=None, precision=None, seed=None):
+		'''
+		Reads a read-level Kraken output file in preview mode and returns a KrakenSample object.
+		With size (--sample), a uniform reservoir of classified reads is kept and only those are scored.
+		With fraction (--fraction), every 1/fraction-th classified read is scored and, if precision is given,
+		reading stops as soon as the 95% confidence interval of every species' read fraction is within +/- precision
+		specmap is a return object from readKReport() call, only its species taxids are considered for the early stopping rule
+		'''
+		if self.ftype != 'krak':
+			raise TypeError(f'INTERNAL ERROR: Cannot call method sampleKraken() on a file with ftype {self.ftype}!')
+
+		if (size is None) == (fraction is None):
+			raise ValueError('INTERNAL ERROR: Exactly one of size or fraction has to be specified for sampleKraken()!')
+
+		path = self._checkPath()
+		total_bytes = os.path.getsize(path)
+		read_bytes = 0
+		classified = 0
+		complete = True
+		sampled = []
+		# Number of sampled reads passing the score cut-off per species taxid (used for the early stopping rule)
+		taxcounts = {}
+
+		stride = None
+		if fraction is not None:
+			stride = max(1, round(1 / fraction))
+		rng = random.Random(seed)
+
+		# Binary mode so that we can keep track of the number of bytes read for extrapolation when stopping early
+		with open(path, 'rb') as f:
+			msg(f'Sampling Kraken output file {self.file}')
+			for raw in f:
+				read_bytes += len(raw)
+				cols = [c.strip() for c in raw.decode().rstrip('\n').split('\t')]
+
+				if cols[0] == 'U':
+					continue
+				classified += 1
+
+				if stride:
+					if (classified - 1) % stride != 0:
+						continue
+
+					kl = KrakenLine(uc=cols[0], read_id=cols[1], taxid=cols[2], kmerstr=cols[4])
+					sampled.append(kl)
+					if kl.score >= self.score and kl.taxid in specmap:
+						taxcounts[kl.taxid] = taxcounts.get(kl.taxid, 0) + 1
+
+					n = len(sampled)
+					# Never stop before at least one species read has been sampled, otherwise there is nothing to estimate
+					if precision and taxcounts and n >= KrakenSample.MIN_SAMPLE and n % KrakenSample.CHECK_EVERY == 0:
+						if KrakenSample.maxHalfWidth(taxcounts, n) <= precision and read_bytes < total_bytes:
+							msg(f'Requested precision of +/- {precision} reached after {n} sampled reads ({round(100 * read_bytes / total_bytes, 2)}% of file {self.file}). Stopping early.')
+							complete = False
+							break
+
+				# Reservoir sampling (Algorithm R), only the kept lines are scored below
+				elif len(sampled) < size:
+					sampled.append(cols)
+				else:
+					j = rng.randrange(classified)
+					if j < size:
+						sampled[j] = cols
+
+		if not stride:
+			sampled = [KrakenLine(uc=cols[0], read_id=cols[1], taxid=cols[2], kmerstr=cols[4]) for cols in sampled]
+
+		population = classified
+		if not complete:
+			# Extrapolate the total number of classified reads from the proportion of the file that has been read
+			population = round(classified * total_bytes / read_bytes)
+
+		krak = [kl for kl in sampled if kl.score >= self.score]
+		msg(f'Sampled {len(sampled)} of {"" if complete else "an estimated "}{population} classified reads in file {self.file} ({len(krak)} with score >= {self.score}).')
+
+		return KrakenSample(kll=krak, n=len(sampled), population=population, complete=complete)
 		
 	def readKReport(self):
 		'''
@@ -181,16 +283,13 @@ class FileReader:
 class Counter:
 
 	@classmethod
-	def getCounts(cls, specmap, kll, truespec, file):
+	def _groupBySpecies(cls, specmap, kll):
 		'''
-		Implements the --counts option to return counts for each species
-		instead of confidence scores for individual reads
-		specmap is a return object from readKReport() call, mapping taxid to species
-		kll is a return object from readKraken() call
+		Groups a list of KrakenLine objects by species-level taxid
+		and returns a dict of taxids mapped to a dict of read_count:, scores: and name:
 		'''
 
 		species = {}
-		result = []
 
 		for kl in kll:
 
@@ -208,6 +307,20 @@ class Counter:
 					if specmap.get(kl.taxid, None):
 							err(f'Another KeyError {e.args[0]} while discarding non-species reads has occurred that should not occur. Exiting.')
 
+		return species
+
+	@classmethod
+	def getCounts(cls, specmap, kll, truespec, file):
+		'''
+		Implements the --counts option to return counts for each species
+		instead of confidence scores for individual reads
+		specmap is a return object from readKReport() call, mapping taxid to species
+		kll is a return object from readKraken() call
+		'''
+
+		species = cls._groupBySpecies(specmap, kll)
+		result = []
+
 		for tx in species:
 			name = species[tx]['name']
 			read_count = species[tx]['read_count']
@@ -218,6 +331,81 @@ class Counter:
 
 		return result
 
+	@classmethod
+	def getSampledCounts(cls, specmap, sample, truespec, file):
+		'''
+		Implements the --counts option in preview mode (--sample / --fraction)
+		and returns estimated counts for each species with 95% confidence intervals on counts and median scores
+		sample is a return object from sampleKraken() call
+		NOTE count intervals treat sample.population as exact, even if it was extrapolated after stopping early
+		'''
+
+		species = cls._groupBySpecies(specmap, sample.kll)
+		result = []
+
+		for tx in species:
+			k = species[tx]['read_count']
+			count_lo, count_hi = KrakenSample.wilson(k, sample.n)
+			median_lo, median_hi = KrakenSample.medianInterval(species[tx]['scores'])
+			cr = SampledCountRecord(file=file, truespec=truespec, kspec=tx, species=species[tx]['name'],
+									read_count=round(k / sample.n * sample.population),
+									median_score=round(median(species[tx]['scores']), 3),
+									read_count_lo=round(count_lo * sample.population),
+									read_count_hi=round(count_hi * sample.population),
+									median_lo=round(median_lo, 3),
+									median_hi=round(median_hi, 3))
+			result.append(cr)
+
+		return result
+
+class KrakenSample:
+	'''A class representing a sample of KrakenLine objects drawn from a Kraken output file in preview mode'''
+
+	# z-value for 95% confidence intervals
+	Z = 1.96
+	# Minimum number of sampled reads before the early stopping rule is evaluated, and how often it is evaluated thereafter
+	MIN_SAMPLE = 1000
+	CHECK_EVERY = 1000
+
+	def __init__(self, kll, n, population, complete):
+		self.kll = kll # sampled KrakenLine objects with score >= cut-off
+		self.n = n # number of sampled classified reads (including those below the score cut-off)
+		self.population = population # (extrapolated from the bytes read, if not complete) number of classified reads in the file
+		self.complete = complete # False if reading stopped early
+
+	@classmethod
+	def wilson(cls, k, n):
+		'''Returns the Wilson score interval for a proportion of k out of n'''
+		if n == 0:
+			return 0.0, 1.0
+
+		p = k / n
+		denom = 1 + cls.Z**2 / n
+		centre = (p + cls.Z**2 / (2 * n)) / denom
+		half = cls.Z * sqrt(p * (1 - p) / n + cls.Z**2 / (4 * n**2)) / denom
+
+		return max(0.0, centre - half), min(1.0, centre + half)
+
+	@classmethod
+	def maxHalfWidth(cls, taxcounts, n):
+		'''Returns the largest half-width of the Wilson score intervals of all taxa in a dict of taxid: count'''
+		widths = [(hi - lo) / 2 for lo, hi in (cls.wilson(k, n) for k in taxcounts.values())]
+
+		return max(widths, default=0.0)
+
+	@classmethod
+	def medianInterval(cls, scores):
+		'''
+		Returns a distribution-free confidence interval of the median of a list of scores
+		based on the order statistics of a binomial(n, 0.5) distribution
+		'''
+		s = sorted(scores)
+		n = len(s)
+		lo = max(0, floor(n / 2 - cls.Z * sqrt(n) / 2) - 1)
+		hi = min(n - 1, ceil(n / 2 + cls.Z * sqrt(n) / 2))
+
+		return s[lo], s[hi]
+
 class KrakenLine:
 	'''A class representing a single line of Kraken output file'''
 	def __init__(self, uc, read_id, taxid, kmerstr):
@@ -279,6 +467,18 @@ class CountRecord(Record):
 	def join(self, sep):
 		return sep.join([self.file, self.truespec, self.kspec, str(self.read_count), str(self.median_score)])
 
+class SampledCountRecord(CountRecord):
+	'''A CountRecord with estimated counts and 95% confidence intervals from preview mode (--sample / --fraction)'''
+	def __init__(self, file, truespec, kspec, species, read_count, median_score, read_count_lo, read_count_hi, median_lo, median_hi):
+		super().__init__(file, truespec, kspec, species, read_count, median_score)
+		self.read_count_lo = read_count_lo
+		self.read_count_hi = read_count_hi
+		self.median_lo = median_lo
+		self.median_hi = median_hi
+
+	def join(self, sep):
+		return sep.join([super().join(sep), str(self.read_count_lo), str(self.read_count_hi), str(self.median_lo), str(self.median_hi)])
+
 class ReadRecord(Record):
 	'''A class that represents a species-read-kmerstring-confidence score object'''
 	def __init__(self, file, truespec, kspec, read_id, score):
@@ -289,15 +489,143 @@ class ReadRecord(Record):
 	def join(self, sep):
 		return sep.join([self.file, self.truespec, self.kspec, str(self.read_id), str(self.score)])
 
+class ReadSorter:
+	'''
+	A class for sorting ReadRecord objects with bounded memory (--sort-by).
+	Records are buffered, and each full buffer is sorted and spilled to a temporary file,
+	the sorted chunks are then merged (at most MAX_CHUNKS at a time) when reading the records back
+	'''
+
+	# Maps --sort-by field names to ReadRecord attributes
+	FIELDS = {'file' : 'file', 'truespec' : 'truespec', 'species' : 'kspec', 'read_id' : 'read_id', 'score' : 'score'}
+	# Maximum number of chunk files opened at once while merging
+	MAX_CHUNKS = 64
+
+	def __init__(self, sort_by, tmpdir, buffer_size=1000000):
+		self.tmpdir = tmpdir
+		self.buffer_size = int(buffer_size)
+		self.buffer = []
+		self.chunks = [] # paths of closed, sorted temporary files
+		self.keys = []
+
+		for field in sort_by.split(','):
+			field, order = (field.strip().split(':') + ['asc'])[:2]
+
+			if field not in self.FIELDS:
+				err(f'Invalid field {field} for --sort-by. Expected a comma-separated list of: {", ".join(self.FIELDS)}. Exiting.')
+			if order not in ('asc', 'desc'):
+				err(f'Invalid sort order {order} for field {field} in --sort-by. Expected "asc" or "desc". Exiting.')
+			if order == 'desc' and field != 'score':
+				err(f'Descending order ("{field}:desc") is only supported for field "score" in --sort-by. Exiting.')
+
+			self.keys.append((self.FIELDS[field], order == 'desc'))
+
+	def _key(self, rec):
+		'''Returns the sort key of a ReadRecord object'''
+		return tuple(-getattr(rec, attr) if desc else getattr(rec, attr) for attr, desc in self.keys)
+
+	def _writeChunk(self, records):
+		'''Writes sorted ReadRecord objects to a temporary file, closes it and returns its path'''
+		fd, path = tempfile.mkstemp(dir=self.tmpdir, prefix='frakka_sort_')
+
+		with os.fdopen(fd, 'w') as fh:
+			for rec in records:
+				print(rec.join('\t'), file=fh)
+
+		return path
+
+	@staticmethod
+	def _readChunk(path):
+		'''Reads ReadRecord objects back from a temporary file and deletes the file when done'''
+		try:
+			with open(path, 'r') as fh:
+				for line in fh:
+					file, truespec, kspec, read_id, score = line.rstrip('\n').split('\t')
+					yield ReadRecord(file=file, truespec=truespec, kspec=kspec, read_id=read_id, score=float(score))
+		finally:
+			os.remove(path)
+
+	def _merge(self, paths):
+		'''Returns a generator merging the sorted records of the given temporary files'''
+		return heapq.merge(*[self._readChunk(p) for p in paths], key=self._key)
+
+	def _spill(self):
+		'''Sorts the buffered records and writes them to a temporary file'''
+		self.buffer.sort(key=self._key)
+		self.chunks.append(self._writeChunk(self.buffer))
+		self.buffer = []
+
+	def add(self, rec):
+		'''Adds a ReadRecord object, spilling the buffer to disk when it is full'''
+		self.buffer.append(rec)
+		if len(self.buffer) >= self.buffer_size:
+			self._spill()
+
+	def records(self):
+		'''Returns a generator of all added ReadRecord objects in sorted order'''
+		if not self.chunks:
+			self.buffer.sort(key=self._key)
+			records = self.buffer
+			self.buffer = []
+			return iter(records)
+
+		if self.buffer:
+			self._spill()
+
+		msg(f'Merging {len(self.chunks)} sorted chunks of up to {self.buffer_size} reads.')
+
+		# Intermediate merge passes, so that no more than MAX_CHUNKS files are open at the same time
+		while len(self.chunks) > self.MAX_CHUNKS:
+			paths = self.chunks[:self.MAX_CHUNKS]
+			self.chunks = self.chunks[self.MAX_CHUNKS:] + [self._writeChunk(self._merge(paths))]
+
+		chunks = self.chunks
+		self.chunks = []
+		return self._merge(chunks)
+
+class ReadSelector:
+	'''
+	A class that keeps the n highest (--top-n) or lowest (--bottom-n) scoring ReadRecord objects
+	per file and species, using one bounded-size heap per file and species
+	'''
+
+	def __init__(self, n, lowest=False):
+		self.n = int(n)
+		self.lowest = lowest
+		self.heaps = {}
+		self.seq = 0
+
+	def add(self, rec):
+		'''Adds a ReadRecord object, replacing the worst kept record of its species if the heap is full'''
+		heap = self.heaps.setdefault((rec.file, rec.kspec), [])
+		# The heap root is the worst kept record, ties are broken in favour of records that were seen first
+		self.seq += 1
+		item = (-rec.score if self.lowest else rec.score, -self.seq, rec)
+
+		if len(heap) < self.n:
+			heapq.heappush(heap, item)
+		else:
+			heapq.heappushpop(heap, item)
+
+	def records(self):
+		'''Returns a list of the kept ReadRecord objects, ordered by file, species and score (best first)'''
+		result = []
+
+		for key in sorted(self.heaps):
+			result += [item[2] for item in sorted(self.heaps[key], reverse=True)]
+
+		return result
+
 class Output:
 	'''A class for output objects (lines to be printed)'''
 
-	def __init__(self, record, fh, isHeader=False, sep='\t', counts=False, useTaxid=False):
+	def __init__(self, record, fh, isHeader=False, sep='\t', counts=False, useTaxid=False, sampled=False):
 		self.fh = fh
 		self.isHeader = isHeader
 		self.sep = sep
 		self.counts = counts
 		self.useTaxid = useTaxid
+		self.sampled = sampled
 
 		if self.isHeader:
 			self.kspec = "K_spec"
@@ -309,6 +637,8 @@ class Output:
 
 			if self.counts:
 				self.record = self.sep.join(['file', self.truespec, self.kspec, 'read_count', 'median_score'])
+				if self.sampled:
+					self.record = self.sep.join([self.record, 'read_count_lo', 'read_count_hi', 'median_score_lo', 'median_score_hi'])
 			else:
 				self.record = self.sep.join(['file', self.truespec, self.kspec, 'read_id', 'score'])
 		else: